@@ -10,10 +10,14 @@ import re
 import os
 import sys
 import json
-import base64
-import argparse
-from collections import namedtuple
-from datetime import datetime, timezone, timedelta, time
+import logging
+from datetime import datetime, timezone, timedelta
+
+try:
+    # orjson is optional, but decodes large bundles much faster
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
 
 if __name__ == '__main__':
     # modify path for local testing
@@ -27,7 +31,7 @@ else:
     from data_access.flatten import flatten
     from algorithms.finder import time_finder
 
-from claritynlp_logging import log, ERROR, DEBUG
+from claritynlp_logging import log
     
 # exported for result display
 KEY_VALUE_NAME    = 'value_name'
@@ -39,16 +43,25 @@ KEY_END_DATE_TIME = 'end_date_time'
 _VERSION_MAJOR = 0
 _VERSION_MINOR = 12
 _MODULE_NAME   = 'cql_result_parser.py'
+_VERSION       = '{0} {1}.{2}'.format(_MODULE_NAME, _VERSION_MAJOR, _VERSION_MINOR)
 
-# set to True to enable debug output
-_TRACE = False
+# debug output is enabled with enable_debug(); until then the logger has
+# its own INFO level, so a host that sets the root logger to DEBUG does not
+# get the per-resource dumps
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
 
 # regex used to recognize components of datetime strings
 _str_datetime = r'\A(?P<year>\d\d\d\d)-(?P<month>\d\d)-(?P<day>\d\d)' \
     r'(T(?P<time>\d\d:\d\d:\d\d[-+\.Z\d:]*))?\Z'
 _regex_datetime = re.compile(_str_datetime)
 
-_regex_coding = re.compile(r'\Acode_coding_(?P<num>\d)_')
+# regex used to decode the common forms of the time component; anything
+# else is handed to the time_finder
+_str_time = r'\A(?P<hours>\d\d):(?P<minutes>\d\d):(?P<seconds>\d\d)' \
+    r'(\.(?P<frac>\d+))?' \
+    r'(Z|(?P<sign>[-+])(?P<delta_hours>\d\d)(:?(?P<delta_min>\d\d))?)?\Z'
+_regex_time = re.compile(_str_time)
 
 _KEY_END         = 'end'
 _KEY_START       = 'start'
@@ -63,213 +76,508 @@ _KEY_RESULT      = 'result'
 _STR_RESOURCE_TYPE = 'resourceType'
 _CHAR_FWDSLASH = '/'
 
+# The list-valued fields of each flattened FHIR resource are described by
+# a 'list spec': a tuple whose entries are either a field name or a
+# (field name, child spec) tuple. The child spec is applied to each element
+# of the list, with field names relative to that element. An empty field
+# name refers to the list element itself. See _set_list_lengths.
+#
+# The spec for each resource type includes the lists common to all
+# resources, so that all of its list lengths come from a single scan of the
+# flattened keys.
+
+_CODING = ('coding',)
+
+# list-valued fields of the extension and modifierExtension elements
+_EXT_SUBFIELDS = (
+    'valueCodeableConcept_coding',
+    'valueTiming_event',
+    'valueTiming_code_coding',
+    'valueAddress_line',
+    'valueHumanName_family',
+    'valueHumanName_given',
+    'valueHumanName_prefix',
+    'valueHumanName_suffix',
+    'valueSignature_type_coding',
+    'extension'                   # inner extension lists
+)
+
+# list-valued fields of a HumanName
+_HN_FIELDS = ('family', 'given', 'prefix', 'suffix')
+
+# list-valued fields common to all resources
+_BASE_LISTS = (
+    ('identifier', ('type_coding',)),
+    ('extension', _EXT_SUBFIELDS),
+    ('modifierExtension', _EXT_SUBFIELDS),
+)
+
+# list-valued fields of a contained Medication resource
+_CONTAINED_MED_LISTS = (
+    ('contained', (
+        'code_coding', 'product_form', 'product_ingredient', 'product_batch',
+        'package_container_coding',
+        ('package_content', _CODING),
+        # DSTU3
+        'form_coding', 'package_batch', 'image',
+        ('ingredient', ('itemCodeableConcept_coding',)),
+    )),
+)
+
+# list-valued fields of a DSTU3 Dosage resource
+_DOSAGE_LISTS = (
+    ('additionalInstruction', _CODING),
+    'site_coding', 'route_coding', 'method_coding',
+)
+
+_OBSERVATION_LISTS = _BASE_LISTS + (
+    'category_coding', 'code_coding', 'performer',
+    'valueCodeableConcept_coding', 'dataAbsentReason_coding',
+    'interpretation_coding', 'bodySite_coding', 'method_coding',
+    ('referenceRange', (
+        'meaning_coding',
+        ('appliesTo', _CODING),     # DSTU3
+    )),
+    ('component', (
+        'code_coding', 'valueCodeableConcept_coding',
+        'dataAbsentReason_coding', 'referenceRange',
+        'interpretation_coding',    # DSTU3
+    )),
+    # DSTU3
+    # could have a contained Patient resource - TBD
+    'basedOn',
+    ('category', _CODING),
+)
+
+_MEDICATION_ADMINISTRATION_LISTS = _BASE_LISTS + _CONTAINED_MED_LISTS + (
+    ('reasonNotGiven', _CODING),
+    ('reasonGiven', _CODING),
+    'medicationCodeableConcept_coding', 'device',
+    'dosage_siteCodeableConcept_coding', 'dosage_route_coding',
+    'dosage_method_coding',
+    # DSTU3
+    'definition', 'partOf', 'category_coding', 'supportingInformation',
+    'performer',
+    ('reasonCode', _CODING),
+    'reasonReference', 'note', 'eventHistory',
+)
+
+_MEDICATION_REQUEST_LISTS = _BASE_LISTS + _CONTAINED_MED_LISTS + (
+    'definition', 'basedOn', 'groupIdentifier_type_coding',
+    'category_coding', 'medicationCodeableConcept_coding',
+    'supportingInformation',
+    ('reasonCode', _CODING),
+    'reasonReference', 'note',
+    ('dosageInstruction', _DOSAGE_LISTS),
+    'detectedIssue', 'eventHistory',
+)
+
+_MEDICATION_ORDER_LISTS = _BASE_LISTS + _CONTAINED_MED_LISTS + (
+    'reasonEnded_coding', 'reasonCodeableConcept_coding',
+    'medicationCodeableConcept_coding',
+    ('dosageInstruction', (
+        'additionalInstructions_coding', 'timing_code_coding',
+        'asNeededCodeableConcept_coding', 'siteCodeableConcept_coding',
+        'route_coding', 'method_coding',
+    )),
+    'dispenseRequest_medicationCodeableConcept_coding',
+    'substitution_type_coding', 'substitution_reason_coding',
+)
+
+_MEDICATION_STATEMENT_LISTS = _BASE_LISTS + _CONTAINED_MED_LISTS + (
+    ('reasonNotTaken', _CODING),
+    'reasonForUseCodeableConcept_coding', 'supportingInformation',
+    'medicationCodeableConcept_coding',
+    ('dosage', (
+        'asNeededCodeableConcept_coding', 'siteCodeableConcept_coding',
+        'route_coding', 'method_coding',
+        # DSTU3
+        ('additionalInstruction', _CODING),
+        'site_coding',
+    )),
+    # DSTU3 only
+    'basedOn', 'partOf',
+    ('category', _CODING),
+    'derivedFrom',
+    ('reasonCode', _CODING),
+    'reasonReference', 'note',
+)
+
+_CONDITION_LISTS = _BASE_LISTS + (
+    'code_coding', 'category_coding', 'severity_coding', 'stage_assessment',
+    ('evidence', (
+        'code_coding', 'detail',
+        ('code', (('coding', _CODING),)),   # DSTU3
+    )),
+    ('bodySite', _CODING),
+    # DSTU3 only
+    ('category', _CODING),
+    'note',
+)
+
+_ENCOUNTER_LISTS = _BASE_LISTS + (
+    'statusHistory',
+    ('type', _CODING),
+    'episodeOfCare', 'incomingReferral',
+    ('participant', (('type', _CODING),)),
+    'priority_coding',
+    ('reason', _CODING),
+    'indication', 'hospitalization_admitSource_coding',
+    'hospitalization_admittingDiagnosis',
+    'hospitalization_reAdmission_coding',
+    ('hospitalization_dietPreference', _CODING),
+    ('hospitalization_specialCourtesy', _CODING),
+    ('hospitalization_specialArrangement', _CODING),
+    'hospitalization_dischargeDiagnosis',
+    'hospitalization_dischargeDisposition_coding',
+    'location', 'classHistory', 'account',
+    ('diagnosis', ('role_coding',)),
+)
+
+_PROCEDURE_LISTS = _BASE_LISTS + _CONTAINED_MED_LISTS + (
+    'category_coding', 'code_coding', 'reasonNotPerformed_coding',
+    ('bodySite', _CODING),
+    'reasonCodeableConcept_coding',
+    ('performer', ('role_coding',)),
+    'outcome_coding', 'report',
+    ('complication', _CODING),
+    ('followUp', _CODING),
+    'notes',
+    ('focalDevice', ('action_coding',)),
+    'used',
+    # DSTU3 only
+    'definition', 'basedOn', 'partOf', 'reasonNotDone_coding',
+    ('reasonCode', _CODING),
+    'reasonReference', 'complicationDetail', 'note',
+    ('usedCode', _CODING),
+)
+
+_PATIENT_LISTS = _BASE_LISTS + (
+    ('name', tuple((field, ('',)) for field in _HN_FIELDS)),
+    'telecom',
+    ('address', ('line',)),
+    'maritalStatus_coding',
+    ('contact', (('relationship', _CODING), ('telecom', _CODING))),
+    'animal_species_coding', 'animal_breed_coding',
+    'animal_genderStatus_coding',
+    ('communication', ('language_coding',)),
+    # DSTU2 uses 'careProvider'; DSTU3 uses 'generalPractitioner'
+    'careProvider', 'generalPractitioner',
+    'link',
+)
+
+# the 'len_' keys for the top-level list fields are built once at import
+_LEN_KEY = {
+    field: sys.intern('len_' + field)
+    for list_spec in (
+        _OBSERVATION_LISTS, _MEDICATION_ADMINISTRATION_LISTS,
+        _MEDICATION_REQUEST_LISTS, _MEDICATION_ORDER_LISTS,
+        _MEDICATION_STATEMENT_LISTS, _CONDITION_LISTS, _ENCOUNTER_LISTS,
+        _PROCEDURE_LISTS, _PATIENT_LISTS)
+    for field in (e[0] if type(e) is tuple else e for e in list_spec)
+}
+
+
+###############################################################################
+def _log_message(msg):
+    """
+    Write a debug message with claritynlp_logging.log, which sends it to
+    the app logger if one has been set up, or to stdout otherwise.
+
+    log() prefixes each message with the class name of its caller's 'self',
+    if any. Calling it from this function, instead of directly from
+    _ClarityLogHandler.emit, keeps the handler's class name out of the
+    output.
+    """
+
+    log(msg)
+
+
+###############################################################################
+class _ClarityLogHandler(logging.Handler):
+    """
+    Logging handler that passes the records from this module's logger to
+    claritynlp_logging.log.
+    """
+
+    def emit(self, record):
+        _log_message(self.format(record))
+
 
 ###############################################################################
 def enable_debug():
+    """
+    Enable the debug messages from this module, which are written with
+    claritynlp_logging.log.
+    """
 
-    global _TRACE
-    _TRACE = True
+    if not _logger.handlers:
+        _logger.addHandler(_ClarityLogHandler())
+    # the messages are not passed on to any root handlers, which would
+    # write them a second time
+    _logger.propagate = False
+    _logger.setLevel(logging.DEBUG)
 
 
 ###############################################################################
 def _dump_dict(dict_obj, msg=None):
     """
-    Print the key-value pairs for the given dict to stdout.
+    Log the key-value pairs for the given dict, if debug output is enabled.
     """
 
+    if not _logger.isEnabledFor(logging.DEBUG):
+        return
+
     assert dict == type(dict_obj)
 
     if msg is not None:
-        log(msg)
+        _logger.debug(msg)
     for k,v in dict_obj.items():
         if k.endswith('div'):
-            log('\t{0} => {1}...'.format(k, v[:16]))
+            _logger.debug('\t%s => %s...', k, v[:16])
         else:
-            log('\t{0} => {1}'.format(k, v))
+            _logger.debug('\t%s => %s', k, v)
 
     
+###############################################################################
+def _to_datetime(year, month, day, hours, minutes, seconds,
+                 fractional_seconds, gmt_delta_sign, gmt_delta_hours,
+                 gmt_delta_minutes):
+    """
+    Construct a timezone-aware python datetime object from the components of
+    a FHIR datetime string.
+    """
+
+    us = 0
+    if fractional_seconds is not None:
+        # convert to int and keep us resolution
+        frac_seconds = int(fractional_seconds)
+        us = frac_seconds % 999999
+
+    # get correct sign for UTC offset
+    mult = 1
+    if gmt_delta_sign is not None:
+        if '-' == gmt_delta_sign:
+            mult = -1
+    delta_hours = 0
+    if gmt_delta_hours is not None:
+        delta_hours = mult * gmt_delta_hours
+    delta_min = 0
+    if gmt_delta_minutes is not None:
+        delta_min   = gmt_delta_minutes
+    offset = timedelta(
+        hours=delta_hours,
+        minutes = delta_min
+    )
+
+    return datetime(
+        year        = year,
+        month       = month,
+        day         = day,
+        hour        = hours,
+        minute      = minutes,
+        second      = seconds,
+        microsecond = us,
+        tzinfo      = timezone(offset=offset)
+    )
+
+
+###############################################################################
+def _is_dt(v):
+    """
+    Return True if v is a string that could be a FHIR datetime, i.e. one that
+    begins with 'YYYY-MM-DD'. This is a cheap check that avoids running the
+    datetime regex on most of the strings in a resource.
+    """
+
+    return type(v) is str and len(v) >= 10 and '-' == v[4] and '-' == v[7]
+
+
+###############################################################################
+def _parse_datetime(v):
+    """
+    Convert a FHIR datetime string to a python datetime object. Returns the
+    string unchanged if it is not a datetime.
+    """
+
+    match = _regex_datetime.match(v)
+    if not match:
+        return v
+
+    year  = int(match.group('year'))
+    month = int(match.group('month'))
+    day   = int(match.group('day'))
+    time_str = match.group('time')
+
+    if time_str is None:
+        datetime_obj = datetime(
+            year  = year,
+            month = month,
+            day   = day
+        )
+    else:
+        time_match = _regex_time.match(time_str)
+        if time_match:
+            delta_hours = time_match.group('delta_hours')
+            if delta_hours is not None:
+                delta_hours = int(delta_hours)
+            delta_min = time_match.group('delta_min')
+            if delta_min is not None:
+                delta_min = int(delta_min)
+            datetime_obj = _to_datetime(
+                year, month, day,
+                int(time_match.group('hours')),
+                int(time_match.group('minutes')),
+                int(time_match.group('seconds')),
+                time_match.group('frac'),
+                time_match.group('sign'),
+                delta_hours,
+                delta_min
+            )
+        else:
+            # unusual format, use the time_finder
+            json_time = time_finder.run(time_str)
+            time_list = json.loads(json_time)
+            assert 1 == len(time_list)
+            the_time = time_list[0]
+
+            # read the fields directly from the decoded dict; building a
+            # TimeValue from it first only adds a keyword-unpacking call
+            datetime_obj = _to_datetime(
+                year, month, day,
+                the_time['hours'],
+                the_time['minutes'],
+                the_time['seconds'],
+                the_time['fractional_seconds'],
+                the_time['gmt_delta_sign'],
+                the_time['gmt_delta_hours'],
+                the_time['gmt_delta_minutes']
+            )
+
+    return datetime_obj
+
+
 ###############################################################################
 def _convert_datetimes(flattened_obj):
     """
     Convert FHIR datetimes to python datetime objects. The input is a flattened
-    JSON representation of a FHIR resource.
+    JSON representation of a FHIR resource. Returns a new dict with the
+    converted values.
     """
 
-    assert dict == type(flattened_obj)
-    
-    for k,v in flattened_obj.items():
-        if str == type(v):
-            match = _regex_datetime.match(v)
-            if match:
-                year  = int(match.group('year'))
-                month = int(match.group('month'))
-                day   = int(match.group('day'))
-                time_str = match.group('time')
-
-                if time_str is None:
-                    datetime_obj = datetime(
-                        year  = year,
-                        month = month,
-                        day   = day
-                    )
-                else:
-                    json_time = time_finder.run(time_str)
-                    time_list = json.loads(json_time)
-                    assert 1 == len(time_list)
-                    the_time = time_list[0]
-                    time_obj = time_finder.TimeValue(**the_time)
-
-                    us = 0
-                    if time_obj.fractional_seconds is not None:
-                        # convert to int and keep us resolution
-                        frac_seconds = int(time_obj.fractional_seconds)
-                        us = frac_seconds % 999999
-
-                    # get correct sign for UTC offset
-                    mult = 1
-                    if time_obj.gmt_delta_sign is not None:
-                        if '-' == time_obj.gmt_delta_sign:
-                            mult = -1
-                    delta_hours = 0
-                    if time_obj.gmt_delta_hours is not None:
-                        delta_hours = mult * time_obj.gmt_delta_hours
-                    delta_min = 0
-                    if time_obj.gmt_delta_minutes is not None:
-                        delta_min   = time_obj.gmt_delta_minutes
-                    offset = timedelta(
-                        hours=delta_hours,
-                        minutes = delta_min
-                    )
-                
-                    datetime_obj = datetime(
-                        year        = year,
-                        month       = month,
-                        day         = day,
-                        hour        = time_obj.hours,
-                        minute      = time_obj.minutes,
-                        second      = time_obj.seconds,
-                        microsecond = us,
-                        tzinfo      = timezone(offset=offset)
-                    )
-
-                flattened_obj[k] = datetime_obj
-                
-    return flattened_obj
+    return {k: _parse_datetime(v) if _is_dt(v) else v
+            for k, v in flattened_obj.items()}
 
 
 ###############################################################################
-def _set_list_length(obj, prefix_str):
+def _compute_all_list_lengths(obj):
+    """
+    Scan the keys of a flattened FHIR resource a single time and return a
+    dict mapping each flattened list prefix to the length of that list.
+
+    A key such as 'contained_0_code_coding_2_code' contributes the prefixes
+    'contained' (index 0) and 'contained_0_code_coding' (index 2).
+    """
+
+    # This loop runs once per key of every resource in a bundle. Splitting
+    # on '_' and testing each segment with str.isdecimal keeps the work in
+    # C string methods; a regex finditer or a str.find loop is slower here.
+    lengths = {}
+    get_length = lengths.get
+    for k in obj:
+        parts = k.split('_')
+        for i in range(1, len(parts)):
+            segment = parts[i]
+            if segment.isdecimal():
+                prefix = '_'.join(parts[:i])
+                length = int(segment) + 1
+                if length > get_length(prefix, 0):
+                    lengths[prefix] = length
+
+    return lengths
+
+
+###############################################################################
+def _set_list_length(obj, prefix_str, lengths):
     """
     Determine the length of a flattened list whose element keys share the
     given prefix string. Add a new key of the form 'len_' + prefix_str that
     contains this length.
-    """
 
-    str_search = r'\A' + prefix_str + r'_(?P<num>\d+)_?'
-
-    max_num = None
-    for k,v in obj.items():
-        match = re.match(str_search, k)
-        if match:
-            num = int(match.group('num'))
-            if max_num is None:
-                max_num = 0
-            if num > max_num:
-                max_num = num
+    The 'lengths' dict is the result of _compute_all_list_lengths for the
+    flattened resource.
+    """
 
-    if max_num is None:
-        return 0
-    else:
-        length = max_num + 1
-        obj['len_' + prefix_str] = length
-        return length
+    length = lengths.get(prefix_str, 0)
+    if length > 0:
+        obj[_LEN_KEY.get(prefix_str) or 'len_' + prefix_str] = length
+    return length
 
 
 ###############################################################################
-def _base_init(obj):
+def _set_list_lengths(obj, list_spec, lengths, base=None):
     """
-    Initialize list lengths in the base resource objects.
+    Set the lengths of all flattened lists described by the given list spec.
+    The 'len_' keys are written to 'obj', which can be any dict, since the
+    lengths come from _compute_all_list_lengths. The 'base' argument is the
+    flattened key of the list element that the field names in the spec are
+    relative to, or None at the top level.
     """
 
-    identifier_count = _set_list_length(obj, 'identifier')
-    for i in range(identifier_count):
-        key_name = 'identifier_{0}_type_coding'.format(i)
-        _set_list_length(obj, key_name)
-
-    for field in ['extension', 'modifierExtension']:
-        count = _set_list_length(obj, field)
-        for i in range(count):
-            key_name = '{0}_{1}_valueCodeableConcept_coding'.format(field, i)
-            _set_list_length(obj, key_name)
-            key_name = '{0}_{1}_valueTiming_event'.format(field, i)
-            _set_list_length(obj, key_name)
-            key_name = '{0}_{1}_valueTiming_code_coding'.format(field, i)
-            _set_list_length(obj, key_name)
-            key_name = '{0}_{1}_valueAddress_line'.format(field, i)
-            _set_list_length(obj, key_name)
-            for hn_field in ['family', 'given', 'prefix', 'suffix']:
-                key_name = '{0}_{1}_valueHumanName_{2}'.format(field, i, hn_field)
-                _set_list_length(obj, key_name)
-            key_name = '{0}_{1}_valueSignature_type_coding'.format(field, i)
-            _set_list_length(obj, key_name)
-            # set lengths of inner extension lists
-            key_name = '{0}_{1}_extension'.format(field, i)
-            _set_list_length(obj, key_name)
-        
+    for entry in list_spec:
+        if type(entry) is tuple:
+            field, child_spec = entry
+        else:
+            field, child_spec = entry, None
+
+        if base is None:
+            prefix_str = field
+        elif field:
+            prefix_str = f'{base}_{field}'
+        else:
+            prefix_str = base
+
+        count = _set_list_length(obj, prefix_str, lengths)
+        if child_spec is not None:
+            for i in range(count):
+                _set_list_lengths(obj, child_spec, lengths,
+                                  f'{prefix_str}_{i}')
 
-###############################################################################        
-def _contained_med_resource_init(obj):
+
+###############################################################################
+def _populate_lengths(obj, list_spec):
     """
-    Process a flattened FHIR Medication resource, which appears only as a
-    contained resource inside other FHIR resources. 
+    Set the lengths of all lists in the list spec, using a single scan of
+    the keys of the flattened resource.
     """
 
-    contained_count = _set_list_length(obj, 'contained')
-    for i in range(contained_count):
-        for field in [
-                'code_coding', 'product_form', 'product_ingredient',
-                'product_batch', 'package_container_coding',
-                'package_content']:
-            key_name = 'contained_{0}_{1}'.format(i, field)
-            _set_list_length(obj, key_name)
+    lengths = _compute_all_list_lengths(obj)
 
-    # DSTU3
-    for i in range(contained_count):
-        for field in ['form_coding', 'package_batch', 'image']:
-            key_name = 'contained_{0}_{1}'.format(i, field)
-            _set_list_length(obj, key_name)
-
-        key_name = 'contained_{0}_ingredient'.format(i)
-        ingredient_count = _set_list_length(obj, key_name)
-        for j in range(ingredient_count):
-            key2_name = '{0}_{1}_itemCodeableConcept_coding'.format(key_name, j)
-            len_k = _set_list_length(obj, key2_name)
-        key_name = 'contained_{0}_package_container_coding'.format(i)
-        _set_list_length(obj, key_name)
-        key_name = 'contained_{0}_package_content'.format(i)
-        len_j = _set_list_length(obj, key_name)
-        for j in range(len_j):
-            key2_name = '{0}_{1}_coding'.format(key_name, j)
-            _set_list_length(obj, key2_name)
+    # collect the 'len_' entries and add them to the resource in one update
+    len_map = {}
+    _set_list_lengths(len_map, list_spec, lengths)
+    obj.update(len_map)
     
 
 ###############################################################################
-def _set_dosage_fields(obj, dosage_field_name):
+def _set_patient_id(obj, ref_key):
     """
-    Set list lengths for a FHIR DSTU3 Dosage embedded resource.
+    Set the 'subject' field of the flattened resource to the patient id in
+    the reference string at obj[ref_key], if any. References have the form
+    'Patient/<id>'; the flattened key is looked up directly, so no path
+    traversal is needed.
     """
 
-    dosage_count = _set_list_length(obj, dosage_field_name)
-    for i in range(dosage_count):
-        key_name = '{0}_{1}_additionalInstruction'.format(dosage_field_name, i)
-        count_j = _set_list_length(obj, key_name)
-        for j in range(count_j):
-            key2_name = '{0}_{1}_coding'.format(key_name, j)
-            _set_list_length(obj, key2_name)
-        for field in ['site', 'route', 'method']:
-            key_name = '{0}_{1}_{2}_coding'.format(dosage_field_name, i, field)
-            _set_list_length(obj, key_name)
-        
+    ref = obj.get(ref_key)
+    if ref is None:
+        return
+
+    if _CHAR_FWDSLASH in ref:
+        resource_type, patient_id = ref.split(_CHAR_FWDSLASH)
+    else:
+        patient_id = None
+    obj[_KEY_SUBJECT] = patient_id
+
 
 ###############################################################################
 def _process_datetime(obj):
@@ -290,8 +598,7 @@ def _process_datetime(obj):
         dt = obj[_KEY_RESULT]
         obj[KEY_DATE_TIME] = dt
     
-    if _TRACE:
-        _dump_dict(flattened_dt, 'Flattened dateTime resource: ')
+    _dump_dict(flattened_dt, 'Flattened dateTime resource: ')
 
     return flattened_dt
     
@@ -307,8 +614,7 @@ def _process_string(obj):
     # flatten the JSON
     flattened_string = flatten(obj)
     
-    if _TRACE:
-        _dump_dict(flattened_string, 'Flattened string resource: ')
+    _dump_dict(flattened_string, 'Flattened string resource: ')
 
     return flattened_string
     
@@ -319,10 +625,7 @@ def _process_observation(obj):
     Process a flattened FHIR 'Observation' resource.
     """
 
-    assert dict == type(obj)
-
-    if _TRACE:
-        _dump_dict(obj, '[BEFORE]: Flattened Observation: ')
+    _dump_dict(obj, '[BEFORE]: Flattened Observation: ')
     
     # add 'date_time' field for time sorting
     if _KEY_EDT in obj:
@@ -335,44 +638,7 @@ def _process_observation(obj):
         end = obj[_KEY_EP_END]
         obj[KEY_END_DATE_TIME] = end
 
-    _base_init(obj)
-    _set_list_length(obj, 'category_coding')
-    _set_list_length(obj, 'code_coding')
-    _set_list_length(obj, 'performer')
-    _set_list_length(obj, 'valueCodeableConcept_coding')
-    _set_list_length(obj, 'dataAbsentReason_coding')
-    _set_list_length(obj, 'interpretation_coding')
-    _set_list_length(obj, 'bodySite_coding')
-    _set_list_length(obj, 'method_coding')
-    rr_count = _set_list_length(obj, 'referenceRange')
-    for i in range(rr_count):
-        key = 'referenceRange_{0}_meaning_coding'.format(i)
-        _set_list_length(obj, key)
-    component_count = _set_list_length(obj, 'component')
-    for i in range(component_count):
-        for field in ['code_coding',
-                      'valueCodeableConcept_coding',
-                      'dataAbsentReason_coding',
-                      'referenceRange']:
-            key = 'component_{0}_{1}'.format(i, field)
-            _set_list_length(obj, key)
-
-    # DSTU3
-    # could have a contained Patient resource - TBD
-    _set_list_length(obj, 'basedOn')
-    category_count = _set_list_length(obj, 'category')
-    for i in range(category_count):
-        key_name = 'category_{0}_coding'.format(i)
-        _set_list_length(obj, key_name)
-    for i in range(rr_count):
-        key_name = 'referenceRange_{0}_appliesTo'.format(i)
-        applies_to_count = _set_list_length(obj, key)
-        for j in range(applies_to_count):
-            key2_name = '{0}_{1}_coding'.format(key_name, j)
-            _set_list_length(obj, key2_name)
-    for i in range(component_count):
-        key_name = 'component_{0}_interpretation_coding'.format(i)
-        _set_list_length(obj, key_name)
+    _populate_lengths(obj, _OBSERVATION_LISTS)
             
     # set value and units for result display
     KEY_VQ    = 'valueQuantity_value'
@@ -394,17 +660,9 @@ def _process_observation(obj):
         obj[KEY_VALUE_NAME] = obj[KEY_DISP2]
 
     # set patient id
-    if _KEY_SUBJECT_REF in obj:
-        subject_ref = obj[_KEY_SUBJECT_REF]
-        if _CHAR_FWDSLASH in subject_ref:
-            resource_type, patient_id = subject_ref.split(_CHAR_FWDSLASH)
-        else:
-            resource_type = subject_ref
-            patient_id = None
-        obj[_KEY_SUBJECT] = patient_id
+    _set_patient_id(obj, _KEY_SUBJECT_REF)
         
-    if _TRACE:
-        _dump_dict(obj, '[AFTER] Flattened Observation: ')
+    _dump_dict(obj, '[AFTER] Flattened Observation: ')
             
     return obj
 
@@ -415,10 +673,7 @@ def _process_medication_administration(obj):
     Process a flattened FHIR 'MedicationAdministration' resource.
     """
 
-    assert dict == type(obj)
-
-    if _TRACE:
-        _dump_dict(obj, '[BEFORE]: Flattened MedicationAdministration: ')
+    _dump_dict(obj, '[BEFORE]: Flattened MedicationAdministration: ')
     
     # add fields for time sorting (DSTU2)
     KEY_EDT = 'effectiveTimeDateTime'
@@ -445,36 +700,7 @@ def _process_medication_administration(obj):
         end = obj[_KEY_EP_END]
         obj[KEY_END_DATE_TIME] = end
         
-    _base_init(obj)
-    _contained_med_resource_init(obj)
-    
-    reason_count = _set_list_length(obj, 'reasonNotGiven')
-    for i in range(reason_count):
-        key = 'reasonNotGiven_{0}_coding'
-        _set_list_length(obj, key)
-    reason_count = _set_list_length(obj, 'reasonGiven')
-    for i in range(reason_count):
-        key = 'reasonGiven_{0}_coding'
-        _set_list_length(obj, key)
-    _set_list_length(obj, 'medicationCodeableConcept_coding')
-    _set_list_length(obj, 'device')
-    _set_list_length(obj, 'dosage_siteCodeableConcept_coding')
-    _set_list_length(obj, 'dosage_route_coding')
-    _set_list_length(obj, 'dosage_method_coding')
-
-    # DSTU3
-    _set_list_length(obj, 'definition')
-    _set_list_length(obj, 'partOf')
-    _set_list_length(obj, 'category_coding')
-    _set_list_length(obj, 'supportingInformation')
-    _set_list_length(obj, 'performer')
-    reason_count = _set_list_length(obj, 'reasonCode')
-    for i in range(reason_count):
-        key_name = 'reasonCode_{0}_coding'.format(i)
-        _set_list_length(obj, key_name)
-    _set_list_length(obj, 'reasonReference')
-    _set_list_length(obj, 'note')
-    _set_list_length(obj, 'eventHistory')
+    _populate_lengths(obj, _MEDICATION_ADMINISTRATION_LISTS)
     
     # set data for result display
     KEY_DISP = 'medicationCodeableConcept_coding_0_display'
@@ -486,17 +712,9 @@ def _process_medication_administration(obj):
             obj[KEY_VALUE_NAME] = obj[KEY_REF]
 
     # set patient id
-    if _KEY_PATIENT_REF in obj:
-        patient_ref = obj[_KEY_PATIENT_REF]
-        if _CHAR_FWDSLASH in patient_ref:
-            resource_type, patient_id = patient_ref.split(_CHAR_FWDSLASH)
-        else:
-            resource_type = patient_ref
-            patient_id = None
-        obj[_KEY_SUBJECT] = patient_id
+    _set_patient_id(obj, _KEY_PATIENT_REF)
             
-    if _TRACE:
-        _dump_dict(obj, '[AFTER]: Flattened MedicationAdministration: ')
+    _dump_dict(obj, '[AFTER]: Flattened MedicationAdministration: ')
 
     return obj
 
@@ -507,10 +725,7 @@ def _process_medication_request(obj):
     Process a flattened FHIR 'MedicationRequest' resource.
     """
 
-    assert dict == type(obj)
-
-    if _TRACE:
-        _dump_dict(obj, '[BEFORE]: Flattened MedicationRequest: ')
+    _dump_dict(obj, '[BEFORE]: Flattened MedicationRequest: ')
     
     # add fields for time sorting
     KEY_DW = 'authoredOn'
@@ -518,24 +733,7 @@ def _process_medication_request(obj):
         dw = obj[KEY_DW]
         obj[KEY_DATE_TIME] = dw
 
-    _base_init(obj)
-    _contained_med_resource_init(obj)
-
-    _set_list_length(obj, 'definition')
-    _set_list_length(obj, 'basedOn')
-    _set_list_length(obj, 'groupIdentifier_type_coding')
-    _set_list_length(obj, 'category_coding')
-    _set_list_length(obj, 'medicationCodeableConcept_coding')
-    _set_list_length(obj, 'supportingInformation')
-    rc_count = _set_list_length(obj, 'reasonCode')
-    for i in range(rc_count):
-        key_name = 'reasonCode_{0}_coding'.format(i)
-        _set_list_length(obj, key_name)
-    _set_list_length(obj, 'reasonReference')
-    _set_list_length(obj, 'note')
-    _set_dosage_fields(obj, 'dosageInstruction')
-    _set_list_length(obj, 'detectedIssue')
-    _set_list_length(obj, 'eventHistory')
+    _populate_lengths(obj, _MEDICATION_REQUEST_LISTS)
     
     # set data for result display
     KEY_DISP = 'medicationCodeableConcept_coding_0_display'
@@ -547,17 +745,9 @@ def _process_medication_request(obj):
             obj[KEY_VALUE_NAME] = obj[KEY_REF]
 
     # set patient id
-    if _KEY_PATIENT_REF in obj:
-        patient_ref = obj[_KEY_PATIENT_REF]
-        if _CHAR_FWDSLASH in patient_ref:
-            resource_type, patient_id = patient_ref.split(_CHAR_FWDSLASH)
-        else:
-            resource_type = patient_ref
-            patient_id = None
-        obj[_KEY_SUBJECT] = patient_id
+    _set_patient_id(obj, _KEY_PATIENT_REF)
     
-    if _TRACE:
-        _dump_dict(obj, '[AFTER]: Flattened MedicationRequest: ')
+    _dump_dict(obj, '[AFTER]: Flattened MedicationRequest: ')
 
     return obj
 
@@ -568,10 +758,7 @@ def _process_medication_order(obj):
     Process a flattened FHIR 'MedicationOrder' resource.
     """
 
-    assert dict == type(obj)
-
-    if _TRACE:
-        _dump_dict(obj, '[BEFORE]: Flattened MedicationOrder: ')
+    _dump_dict(obj, '[BEFORE]: Flattened MedicationOrder: ')
     
     # add fields for time sorting
     KEY_DW = 'dateWritten'
@@ -584,24 +771,7 @@ def _process_medication_order(obj):
         de = obj[KEY_DE]
         obj[KEY_END_DATE_TIME] = de
 
-    _base_init(obj)
-    _contained_med_resource_init(obj)
-    
-    _set_list_length(obj, 'reasonEnded_coding')
-    _set_list_length(obj, 'reasonCodeableConcept_coding')
-    _set_list_length(obj, 'medicationCodeableConcept_coding')
-    inst_count = _set_list_length(obj, 'dosageInstruction')
-    for i in range(inst_count):
-        for field in ['additionalInstructions_coding',
-                      'timing_code_coding',
-                      'asNeededCodeableConcept_coding',
-                      'siteCodeableConcept_coding',
-                      'route_coding', 'method_coding']:
-            key = 'dosageInstruction_{0}_{1}'.format(i, field)
-            _set_list_length(obj, key)
-    _set_list_length(obj, 'dispenseRequest_medicationCodeableConcept_coding')
-    _set_list_length(obj, 'substitution_type_coding')
-    _set_list_length(obj, 'substitution_reason_coding')
+    _populate_lengths(obj, _MEDICATION_ORDER_LISTS)
 
     # set data for result display
     KEY_DISP = 'medicationCodeableConcept_coding_0_display'
@@ -613,17 +783,9 @@ def _process_medication_order(obj):
             obj[KEY_VALUE_NAME] = obj[KEY_REF]
 
     # set patient id
-    if _KEY_PATIENT_REF in obj:
-        patient_ref = obj[_KEY_PATIENT_REF]
-        if _CHAR_FWDSLASH in patient_ref:
-            resource_type, patient_id = patient_ref.split(_CHAR_FWDSLASH)
-        else:
-            resource_type = patient_ref
-            patient_id = None
-        obj[_KEY_SUBJECT] = patient_id
+    _set_patient_id(obj, _KEY_PATIENT_REF)
     
-    if _TRACE:
-        _dump_dict(obj, '[AFTER]: Flattened MedicationOrder: ')
+    _dump_dict(obj, '[AFTER]: Flattened MedicationOrder: ')
 
     return obj
                 
@@ -634,10 +796,7 @@ def _process_medication_statement(obj):
     Process a flattened FHIR 'MedicationStatement' resource.
     """
 
-    assert dict == type(obj)
-
-    if _TRACE:
-        _dump_dict(obj, '[BEFORE]: Flattened Medication Statement: ')    
+    _dump_dict(obj, '[BEFORE]: Flattened Medication Statement: ')    
 
     # add fields for time sorting
     KEY_DA = 'dateAsserted'
@@ -645,46 +804,7 @@ def _process_medication_statement(obj):
         da = obj[KEY_DA]
         obj[KEY_DATE_TIME] = da
     
-    _base_init(obj)
-    _contained_med_resource_init(obj)
-    
-    reason_count = _set_list_length(obj, 'reasonNotTaken')
-    for i in range(reason_count):
-        key = 'reason_{0}_coding'
-        _set_list_length(obj, key)
-    _set_list_length(obj, 'reasonForUseCodeableConcept_coding')
-    _set_list_length(obj, 'supportingInformation')
-    _set_list_length(obj, 'medicationCodeableConcept_coding')
-    dosage_count = _set_list_length(obj, 'dosage')
-    for i in range(dosage_count):
-        for field in ['asNeededCodeableConcept_coding',
-                      'siteCodeableConcept_coding',
-                      'route_coding', 'method_coding']:
-            key = 'dosage_{0}_{1}'.format(i, field)
-            _set_list_length(obj, key)
-
-    # DSTU3 only
-    _set_list_length(obj, 'basedOn')
-    _set_list_length(obj, 'partOf')
-    category_count = _set_list_length(obj, 'category')
-    for i in range(category_count):
-        key_name = 'category_{0}_coding'.format(i)
-        _set_list_length(obj, key_name)
-    _set_list_length(obj, 'derivedFrom')
-    reason_code_count = _set_list_length(obj, 'reasonCode')
-    for i in range(reason_code_count):
-        key_name = 'reasonCode_{0}_coding'.format(i)
-        _set_list_length(obj, key_name)
-    reason_ref_count = _set_list_length(obj, 'reasonReference')
-    _set_list_length(obj, 'note')
-    for i in range(dosage_count):
-        key_name = 'dosage_{0}_additionalInstruction'.format(i)
-        count_j = _set_list_length(obj, key_name)
-        for j in range(count_j):
-            key2_name = '{0}_{1}_coding'.format(key_name, j)
-            _set_list_length(obj, key2_name)
-        key_name = 'site_{0}_coding'.format(i)
-        _set_list_length(obj, key_name)
+    _populate_lengths(obj, _MEDICATION_STATEMENT_LISTS)
     
     # set data for result display
     KEY_DISP = 'medicationCodeableConcept_coding_0_display'
@@ -696,17 +816,9 @@ def _process_medication_statement(obj):
             obj[KEY_VALUE_NAME] = obj[KEY_REF]
 
     # set patient id
-    if _KEY_PATIENT_REF in obj:
-        patient_ref = obj[_KEY_PATIENT_REF]
-        if _CHAR_FWDSLASH in patient_ref:
-            resource_type, patient_id = patient_ref.split(_CHAR_FWDSLASH)
-        else:
-            resource_type = patient_ref
-            patient_id = None
-        obj[_KEY_SUBJECT] = patient_id
+    _set_patient_id(obj, _KEY_PATIENT_REF)
                 
-    if _TRACE:
-        _dump_dict(obj, '[AFTER]: Flattened Medication Statement: ')
+    _dump_dict(obj, '[AFTER]: Flattened Medication Statement: ')
 
     return obj
 
@@ -717,10 +829,7 @@ def _process_condition(obj):
     Process a flattened FHIR 'Condition' resource.
     """
 
-    assert dict == type(obj)
-
-    if _TRACE:
-        _dump_dict(obj, '[BEFORE]: Flattened Condition: ')    
+    _dump_dict(obj, '[BEFORE]: Flattened Condition: ')    
 
     KEY_ODT      = 'onsetDateTime'
     KEY_OP_START = 'onsetPeriod_start'
@@ -742,36 +851,7 @@ def _process_condition(obj):
         end = obj[KEY_AP_END]
         obj[KEY_END_DATE_TIME] = end
     
-    _base_init(obj)
-    _set_list_length(obj, 'code_coding')
-    _set_list_length(obj, 'category_coding')
-    _set_list_length(obj, 'severity_coding')
-    _set_list_length(obj, 'stage_assessment')
-    evidence_len = _set_list_length(obj, 'evidence')
-    for i in range(evidence_len):
-        for field in ['code_coding', 'detail']:
-            key = 'evidence_{0}_{1}'.format(i, field)
-            _set_list_length(obj, key)
-    site_count = _set_list_length(obj, 'bodySite')
-    for i in range(site_count):
-        key_name = 'bodySite_{0}_coding'.format(i)
-        _set_list_length(obj, key_name)
-
-    # DSTU3 only
-    category_count = _set_list_length(obj, 'category')
-    for i in range(category_count):
-        key_name = 'category_{0}_coding'.format(i)
-        _set_list_length(obj, key_name)
-    for i in range(evidence_len):
-        key_name = 'evidence_{0}_code'.format(i)
-        code_len = _set_list_length(obj, key_name)
-        for j in range(code_len):
-            key2_name = '{0}_{1}_coding'.format(key_name, j)
-            coding_len = _set_list_length(obj, key2_name)
-            for k in range(coding_len):
-                key3_name = '{0}_{1}_coding'.format(key2_name, k)
-                _set_list_length(obj, key3_name)
-    note_count = _set_list_length(obj, 'note')
+    _populate_lengths(obj, _CONDITION_LISTS)
         
     # set data for result display
     KEY_DISP = 'code_coding_0_display'
@@ -779,17 +859,9 @@ def _process_condition(obj):
         obj[KEY_VALUE_NAME] = obj[KEY_DISP]
 
     # set patient id
-    if _KEY_PATIENT_REF in obj:
-        patient_ref = obj[_KEY_PATIENT_REF]
-        if _CHAR_FWDSLASH in patient_ref:
-            resource_type, patient_id = patient_ref.split(_CHAR_FWDSLASH)
-        else:
-            resource_type = patient_ref
-            patient_id = None
-        obj[_KEY_SUBJECT] = patient_id
+    _set_patient_id(obj, _KEY_PATIENT_REF)
         
-    if _TRACE:
-        _dump_dict(obj, '[AFTER]: Flattened Condition: ')
+    _dump_dict(obj, '[AFTER]: Flattened Condition: ')
 
     return obj
     
@@ -800,10 +872,7 @@ def _process_encounter(obj):
     Process a FHIR 'Ecounter resource.
     """
 
-    assert dict == type(obj)
-    
-    if _TRACE:
-        _dump_dict(obj, '[BEFORE]: Flattened Encounter: ')
+    _dump_dict(obj, '[BEFORE]: Flattened Encounter: ')
 
     # add fields for time sorting
     
@@ -816,56 +885,9 @@ def _process_encounter(obj):
         end = obj[KEY_PE]
         obj[KEY_END_DATE_TIME] = end
 
-    _base_init(obj)
-    _set_list_length(obj, 'statusHistory')
-    count = _set_list_length(obj, 'type')
-    for i in range(count):
-        key_name = 'type_{0}_coding'.format(i)
-        _set_list_length(obj, key_name)
-    
-    _set_list_length(obj, 'episodeOfCare')
-    _set_list_length(obj, 'incomingReferral')
-    participant_count = _set_list_length(obj, 'participant')
-    for i in range(participant_count):
-        key_name = 'participant_{0}_type'.format(i)
-        type_count = _set_list_length(obj, key_name)
-        for j in range(type_count):
-            key2_name = '{0}_{1}_{2}'.format(key_name, j, 'coding')
-            _set_list_length(obj, key2_name)
-    _set_list_length(obj, 'priority_coding')
-    reason_count = _set_list_length(obj, 'reason')
-    for i in range(reason_count):
-        key_name = 'reason_{0}_coding'.format(i)
-        _set_list_length(obj, key_name)
-    _set_list_length(obj, 'indication')
-    _set_list_length(obj, 'hospitalization_admitSource_coding')
-    _set_list_length(obj, 'hospitalization_admittingDiagnosis')
-    _set_list_length(obj, 'hospitalization_reAdmission_coding')
-    hdp_count = _set_list_length(obj, 'hospitalization_dietPreference')
-    for i in range(hdp_count):
-        key_name = 'hospitalization_dietPreference_{0}_coding'.format(i)
-        _set_list_length(obj, key_name)
-    sc_count = _set_list_length(obj, 'hospitalization_specialCourtesy')
-    for i in range(sc_count):
-        key_name = 'hospitalization_specialCourtesy_{0}_coding'.format(i)
-        _set_list_length(obj, key_name)
-    sa_count = _set_list_length(obj, 'hospitalization_specialArrangement')
-    for i in range(sa_count):
-        key_name = 'hospitalization_specialArrangement_{0}_coding'.format(i)
-        _set_list_length(obj, key_name)
-    _set_list_length(obj, 'hospitalization_dischargeDiagnosis')
-    coding_count = _set_list_length(obj, 'hospitalization_dischargeDisposition_coding')
-    _set_list_length(obj, 'location')
-
-    _set_list_length(obj, 'classHistory')
-    _set_list_length(obj, 'account')
-    count = _set_list_length(obj, 'diagnosis')
-    for i in range(count):
-        key_name = 'diagnosis_{0}_role_coding'.format(i)
-        _set_list_length(obj, key_name)
+    _populate_lengths(obj, _ENCOUNTER_LISTS)
     
-    if _TRACE:
-        _dump_dict(obj, '[AFTER]: Flattened Encounter: ')
+    _dump_dict(obj, '[AFTER]: Flattened Encounter: ')
 
     return obj
 
@@ -876,10 +898,7 @@ def _process_procedure(obj):
     Process a flattened FHIR 'Procedure' resource.
     """
 
-    assert dict == type(obj)
-
-    if _TRACE:
-        _dump_dict(obj, '[BEFORE]: Flattened Procedure: ')
+    _dump_dict(obj, '[BEFORE]: Flattened Procedure: ')
 
     # add fields for time sorting
     KEY_PDT = 'performedDateTime'
@@ -896,54 +915,7 @@ def _process_procedure(obj):
         end = obj[KEY_PP_END]
         obj[KEY_END_DATE_TIME] = end
     
-    _base_init(obj)
-    _contained_med_resource_init(obj)
-
-    _set_list_length(obj, 'category_coding')
-    _set_list_length(obj, 'code_coding')
-    _set_list_length(obj, 'reasonNotPerformed_coding')
-    site_count = _set_list_length(obj, 'bodySite')
-    for i in range(site_count):
-        key_name = 'bodySite_{0}_coding'.format(i)
-        _set_list_length(obj, key_name)
-    _set_list_length(obj, 'reasonCodeableConcept_coding')
-    performer_count = _set_list_length(obj, 'performer')
-    for i in range(performer_count):
-        key_name = 'performer_{0}_role_coding'.format(i)
-        _set_list_length(obj, key_name)
-    _set_list_length(obj, 'outcome_coding')
-    _set_list_length(obj, 'report')
-    complication_count = _set_list_length(obj, 'complication')
-    for i in range(complication_count):
-        key_name = 'complication_{0}_coding'.format(i)
-        _set_list_length(obj, key_name)
-    followup_count = _set_list_length(obj, 'followUp')
-    for i in range(followup_count):
-        key_name = 'followUp_{0}_coding'.format(i)
-        _set_list_length(obj, key_name)
-    _set_list_length(obj, 'notes')
-    device_count = _set_list_length(obj, 'focalDevice')
-    for i in range(device_count):
-        key_name = 'focalDevice_{0}_action_coding'.format(i)
-        _set_list_length(obj, key_name)
-    _set_list_length(obj, 'used')
-
-    # DSTU3 only
-    _set_list_length(obj, 'definition')
-    _set_list_length(obj, 'basedOn')
-    _set_list_length(obj, 'partOf')
-    _set_list_length(obj, 'reasonNotDone_coding')
-    reason_count = _set_list_length(obj, 'reasonCode')
-    for i in range(reason_count):
-        key_name = 'reasonCode_{0}_coding'.format(i)
-        _set_list_length(obj, key_name)
-    _set_list_length(obj, 'reasonReference')
-    _set_list_length(obj, 'complicationDetail')
-    _set_list_length(obj, 'note')
-    used_code_count = _set_list_length(obj, 'usedCode')
-    for i in range(used_code_count):
-        key_name = 'usedCode_{0}_coding'.format(i)
-        _set_list_length(obj, key_name)
+    _populate_lengths(obj, _PROCEDURE_LISTS)
     
     # set data for result display
     KEY_DISP = 'code_coding_0_display'
@@ -951,17 +923,9 @@ def _process_procedure(obj):
         obj[KEY_VALUE_NAME] = obj[KEY_DISP]
 
     # set patient ID
-    if _KEY_SUBJECT_REF in obj:
-        subject_ref = obj[_KEY_SUBJECT_REF]
-        if _CHAR_FWDSLASH in subject_ref:
-            resource_type, patient_id = subject_ref.split(_CHAR_FWDSLASH)
-        else:
-            resource_type = subject_ref
-            patient_id = None
-        obj[_KEY_SUBJECT] = patient_id
+    _set_patient_id(obj, _KEY_SUBJECT_REF)
     
-    if _TRACE:
-        _dump_dict(obj, '[AFTER]: Flattened Procedure: ')
+    _dump_dict(obj, '[AFTER]: Flattened Procedure: ')
 
     return obj
         
@@ -969,7 +933,8 @@ def _process_procedure(obj):
 ###############################################################################
 def _process_patient(obj):
     """
-    Process a FHIR 'Patient' resource.
+    Process a FHIR 'Patient' resource, given either as a JSON string or as
+    an unflattened dict.
     """
 
     obj_type = type(obj)
@@ -977,65 +942,30 @@ def _process_patient(obj):
         
         # not flattened yet
         try:
-            obj = json.loads(obj)
-        except json.decoder.JSONDecoderError as e:
+            obj = _json_loads(obj)
+        except json.decoder.JSONDecodeError as e:
             log('\t{0}: String conversion (patient) failed with error: "{1}"'.
                   format(_MODULE_NAME, e))
-            return result
+            return None
 
-        # the type instantiated from the string should be a dict
-        obj_type = type(obj)
-        
-    assert dict == obj_type
+    # the type instantiated from the string should be a dict
+    assert isinstance(obj, dict)
 
     flattened_patient = flatten(obj)
     flattened_patient = _convert_datetimes(flattened_patient)
+    return _process_flattened_patient(flattened_patient)
 
-    if _TRACE:
-        _dump_dict(flattened_patient, '[BEFORE] Flattened Patient resource: ')
-    
-    _base_init(flattened_patient)
-
-    name_count = _set_list_length(flattened_patient, 'name')
-    for i in range(name_count):
-        for field in ['family', 'given', 'prefix', 'suffix']:
-            key_name = 'name_{0}_{1}'.format(i, field)
-            count = _set_list_length(flattened_patient, key_name)
-            for j in range(count):
-                key = '{0}_{1}'.format(key_name, j)
-                _set_list_length(flattened_patient, key)
-
-    _set_list_length(flattened_patient, 'telecom')
-    addr_count = _set_list_length(flattened_patient, 'address')
-    for i in range(addr_count):
-        key_name = 'address_{0}_line'.format(i)
-        _set_list_length(flattened_patient, key_name)
-
-    _set_list_length(flattened_patient, 'maritalStatus_coding')
-    
-    contact_count = _set_list_length(flattened_patient, 'contact')
-    for i in range(contact_count):
-        for field in ['relationship', 'telecom']:
-            key_name = 'contact_{0}_{1}'.format(i, field)
-            count = _set_list_length(flattened_patient, key_name)
-            for j in range(count):
-                key = '{0}_{1}_coding'.format(key_name, j)
-                _set_list_length(flattened_patient, key)
-
-    _set_list_length(flattened_patient, 'animal_species_coding')
-    _set_list_length(flattened_patient, 'animal_breed_coding')
-    _set_list_length(flattened_patient, 'animal_genderStatus_coding')    
-
-    comm_count = _set_list_length(flattened_patient, 'communication')
-    for i in range(comm_count):
-        key_name = 'communication_{0}_language_coding'.format(i)
-        _set_list_length(flattened_patient, key_name)
 
-    # DSTU2 uses 'careProvider'; DSTU3 uses 'generalPractitioner'
-    _set_list_length(flattened_patient, 'careProvider')
-    _set_list_length(flattened_patient, 'generalPractitioner')
+###############################################################################
+def _process_flattened_patient(flattened_patient):
+    """
+    Process a flattened FHIR 'Patient' resource whose datetimes have already
+    been converted.
+    """
+
+    _dump_dict(flattened_patient, '[BEFORE] Flattened Patient resource: ')
     
-    _set_list_length(flattened_patient, 'link')
+    _populate_lengths(flattened_patient, _PATIENT_LISTS)
 
     # set data for result display
     family = ''
@@ -1048,72 +978,67 @@ def _process_patient(obj):
         given = flattened_patient['name_0_given']
     elif 'name_0_given_0' in flattened_patient:
         given = flattened_patient['name_0_given_0']
-    name = '{0}, {1}'.format(family, given)
-    flattened_patient[KEY_VALUE_NAME] = name
+    flattened_patient[KEY_VALUE_NAME] = f'{family}, {given}'
 
     # set 'subject' field to the patient_id
     if 'id' in flattened_patient:
         flattened_patient[_KEY_SUBJECT] = str(flattened_patient['id'])
     
-    if _TRACE:
-        _dump_dict(flattened_patient, '[AFTER] Flattened Patient resource: ')
+    _dump_dict(flattened_patient, '[AFTER] Flattened Patient resource: ')
 
     return flattened_patient
 
 
+# FHIR resource types decoded by _process_resource, with their processors
+_RESOURCE_PROCESSORS = {
+##    'Patient'                  : _process_flattened_patient,
+    'Encounter'                : _process_encounter,
+    'Observation'              : _process_observation,
+    'Procedure'                : _process_procedure,
+    'Condition'                : _process_condition,
+    'MedicationStatement'      : _process_medication_statement,
+    'MedicationOrder'          : _process_medication_order,
+    'MedicationRequest'        : _process_medication_request,
+    'MedicationAdministration' : _process_medication_administration,
+}
+
+
 ###############################################################################
 def _process_resource(obj):
     """
     Flatten and process FHIR resources of the indicated types.
     """
 
-    obj_type = type(obj)
-    assert dict == obj_type
+    assert isinstance(obj, dict)
+
+    # read the resource type first, so that the work of flattening is
+    # skipped for resources that are not processed
+    processor = _RESOURCE_PROCESSORS.get(obj.get(_STR_RESOURCE_TYPE))
+    if processor is None:
+        return None
 
     # flatten the JSON, convert time strings to datetimes
     flattened_obj = flatten(obj)
     flattened_obj = _convert_datetimes(flattened_obj)
 
-    # read the resource type and process accordingly
-    result = None
-    if _STR_RESOURCE_TYPE in flattened_obj:
-        rt = obj[_STR_RESOURCE_TYPE]
-##        if 'Patient' == rt:
-##            result = _process_patient(flattened_obj)
-        if 'Encounter' == rt:
-            result = _process_encounter(flattened_obj)
-        elif 'Observation' == rt:
-            result = _process_observation(flattened_obj)
-        elif 'Procedure' == rt:
-            result = _process_procedure(flattened_obj)
-        elif 'Condition' == rt:
-            result = _process_condition(flattened_obj)
-        elif 'MedicationStatement' == rt:
-            result = _process_medication_statement(flattened_obj)
-        elif 'MedicationOrder' == rt:
-            result = _process_medication_order(flattened_obj)
-        elif 'MedicationRequest' == rt:
-            result = _process_medication_request(flattened_obj)
-        elif 'MedicationAdministration' == rt:
-            result = _process_medication_administration(flattened_obj)
-
-    return result
+    return processor(flattened_obj)
     
 
 ###############################################################################
-def _process_bundle(name, bundle_obj, result_type_str):
+def _process_bundle(name, bundle_obj):
     """
     Process a DSTU2 or DSTU3 resource bundle returned from the CQL Engine.
+    The caller has already checked the result type of the bundle.
     """
 
-    if _TRACE: log('Decoding BUNDLE resource...')
+    _logger.debug('Decoding BUNDLE resource...')
 
     # this bundle should be a string representation of a list of dicts
     obj_type = type(bundle_obj)
     assert str == obj_type
     
     try:
-        obj = json.loads(bundle_obj)
+        obj = _json_loads(bundle_obj)
     except json.decoder.JSONDecodeError as e:
         log('\t{0}: String conversion (bundle) failed with error: "{1}"'.
               format(_MODULE_NAME, e))
@@ -1123,20 +1048,30 @@ def _process_bundle(name, bundle_obj, result_type_str):
     obj_type = type(obj)
     assert list == obj_type
 
-    rts = result_type_str.lower()
-    
-    bundled_objs = []    
-    for elt in obj:
-        if rts.endswith('stu2') or rts.endswith('stu3'):
-            result = _process_resource(elt)
-        if result is not None:
-            # insert the name as the 'cql_feature'
-            result['cql_feature'] = name
-            bundled_objs.append(result)
+    results = map(_process_resource, obj)
+    bundled_objs = [result for result in results if result is not None]
+
+    # insert the name as the 'cql_feature'
+    for result in bundled_objs:
+        result['cql_feature'] = name
     
     return bundled_objs
 
 
+# decoders for the CQL Engine result types, called with the result name and
+# the top-level object; the DSTU2 and DSTU3 resource bundles are identified
+# by the result type suffix
+_RESULT_DECODERS = {
+    'string'   : lambda name, obj: _process_string(obj),
+    'datetime' : lambda name, obj: _process_datetime(obj),
+##    'patient'  : lambda name, obj: _process_patient(obj['result']),
+}
+_BUNDLE_DECODERS = {
+    'stu2' : lambda name, obj: _process_bundle(name, obj['result']),
+    'stu3' : lambda name, obj: _process_bundle(name, obj['result']),
+}
+
+
 ###############################################################################
 def decode_top_level_obj(obj):
     """
@@ -1147,48 +1082,28 @@ def decode_top_level_obj(obj):
     KEY_NAME        = 'name'
     KEY_RESULT      = 'result'
     KEY_RESULT_TYPE = 'resultType'
-    STR_PATIENT     = 'patient'
-    STR_STR         = 'string'
-    STR_DT          = 'datetime'
     
     result_obj = None
     
-    obj_type = type(obj)
-    if dict == obj_type:
-        if _TRACE: log('top_level_obj dict keys: {0}'.format(obj.keys()))
+    if isinstance(obj, dict):
+        _logger.debug('top_level_obj dict keys: %s', obj.keys())
 
         name = None
         if KEY_NAME in obj:
             name = obj[KEY_NAME]
         if KEY_RESULT_TYPE in obj and KEY_RESULT in obj:
-            result_obj = obj[KEY_RESULT]
             result_type_str = obj[KEY_RESULT_TYPE].lower()
 
-            if STR_STR == result_type_str:
-                # process original obj if String type
-                result_obj = _process_string(obj)
-                if _TRACE:
-                    log('decoded string resource')
-            elif STR_DT == result_type_str:
-                # process original obj if dateTime type
-                result_obj = _process_datetime(obj)
-                if _TRACE:
-                    log('decoded dateTime resource')
-      ##      elif STR_PATIENT == result_type_str:
-      ##          result_obj = _process_patient(result_obj)
-      ##          if _TRACE:
-      ##             log('decoded patient resource')
+            decoder = _RESULT_DECODERS.get(result_type_str)
+            if decoder is None:
+                decoder = _BUNDLE_DECODERS.get(result_type_str[-4:])
+
+            if decoder is not None:
+                result_obj = decoder(name, obj)
+                _logger.debug('decoded %s resource', result_type_str)
             else:
-                # check for DSTU2 or DSTU3 resource bundles
-                if result_type_str.endswith('stu2') or \
-                   result_type_str.endswith('stu3'):    
-                    result_obj = _process_bundle(name,
-                                                 result_obj,
-                                                 result_type_str)
-                else:
-                    if _TRACE:
-                        log('\n*** decode_top_level_object: no decode ***')
-                    result_obj = None
+                _logger.debug('\n*** decode_top_level_object: no decode ***')
+                result_obj = None
     else:
         # not sure what else to expect here
         assert False
@@ -1198,12 +1113,14 @@ def decode_top_level_obj(obj):
 
 ###############################################################################
 def _get_version():
-    return '{0} {1}.{2}'.format(_MODULE_NAME, _VERSION_MAJOR, _VERSION_MINOR)
+    return _VERSION
 
 
 ###############################################################################
 if __name__ == '__main__':
 
+    import argparse
+
     parser = argparse.ArgumentParser(
         description='Flatten and process FHIR resource examples')
 
@@ -1235,20 +1152,20 @@ if __name__ == '__main__':
         print('Required "--filepath" argument not found.')
         sys.exit(-1)
     
-    with open(filepath, 'rt') as infile:
-        json_string = infile.read()
-        json_data = json.loads(json_string)
+    # orjson decodes bytes directly, and the json fallback accepts them also
+    with open(filepath, 'rb') as infile:
+        json_data = _json_loads(infile.read())
 
         result = _process_resource(json_data)
 
         print('RESULT: ')
         if result is not None:
             for k,v in result.items():
-                if dict == type(v):
+                if isinstance(v, dict):
                     print('\t{0}'.format(k))
                     for k2,v2 in v.items():
                         print('\t\t{0} => {1}'.format(k2, v2))
-                elif list == type(v):
+                elif isinstance(v, list):
                     print('\t{0}'.format(k))
                     for index, v2 in enumerate(v):
                         print('\t\t[{0}]:\t{1}'.format(index, v2))
@@ -154,10 +154,7 @@ import os
 import sys
 import copy
 import string
-import optparse
-from pymongo import MongoClient
 from collections import namedtuple
-from bson.objectid import ObjectId
 from claritynlp_logging import log, ERROR, DEBUG
 
 try:
@@ -352,6 +349,9 @@ _TMP_FEATURE_LOGIC = 1
 
 _EXPR_INDEX = 0
 
+# number of docs returned per round trip by MongoDB cursors
+_CURSOR_BATCH_SIZE = 1000
+
 
 ###############################################################################
 def enable_debug():
@@ -1301,8 +1301,8 @@ def _run_math_pipeline(pipeline, mongo_collection_obj):
     # run the aggregation pipeline
     cursor = mongo_collection_obj.aggregate(pipeline, allowDiskUse=True)
 
-    # keep all doc ids for which the aggregation result is True
-    doc_ids = [doc['_id'] for doc in cursor if doc['value']]
+    # the pipeline returns only the docs satisfying the expression
+    doc_ids = [doc['_id'] for doc in cursor]
 
     return doc_ids
 
@@ -1480,11 +1480,11 @@ def _eval_math_expr(job_id,
     # should only have a single element left on the stack, the result
     assert 1 == len(stack)
 
-    # Create a result document containing a Boolean 'value' field, which will
-    # be set to True for all documents satisfying the mathematical expression.
+    # Keep only the documents satisfying the mathematical expression, so that
+    # the filtering is done by MongoDB and only matching docs are returned.
     op_stage = {
-        "$project": {
-            "value": stack[0]
+        "$match": {
+            "$expr": stack[0]
         }
     }
 
@@ -1514,6 +1514,13 @@ def _eval_math_expr(job_id,
     pipeline = [
         initial_filter,
         op_stage,
+
+        # only the _id values of the matching docs are needed
+        {
+            "$project": {
+                "_id": 1
+            }
+        },
     ]
 
     if _TRACE:
@@ -2036,6 +2043,7 @@ def flatten_logical_result(eval_result, mongo_collection_obj):
 
     # query for these documents
     cursor = mongo_collection_obj.find({'_id': {'$in': doc_ids}})
+    cursor.batch_size(_CURSOR_BATCH_SIZE)
 
     # load all docs into a map for quick access to data
     features = set()
@@ -23,11 +23,11 @@ PhenotypeInfo = namedtuple('PhenotypeInfo', PHENOTYPE_INFO_FIELDS)
 HISTORY_FIELD = 'history'
 
 # these fields are not copied from source doc to result doc
-_NO_COPY_FIELDS = [
+_NO_COPY_FIELDS = frozenset([
     '_id', 'job_id', 'phenotype_id', 'owner',
     'job_date', 'context_type', 'raw_definition_text',
     'nlpql_feature', 'phenotype_final', HISTORY_FIELD
-]
+])
 
 
 ###############################################################################
@@ -248,21 +248,10 @@ def to_math_result_docs(eval_result, phenotype_info, cursor):
 
     for doc in cursor:
 
-        # output doc
-        ret = {}
-
-        # add doc fields to the output doc as lists
-        field_map = {}
-        fields = doc.keys()
-        fields_to_copy = [f for f in fields if f not in _NO_COPY_FIELDS]
-        for f in fields_to_copy:
-            if f not in field_map:
-                field_map[f] = [doc[f]]
-            else:
-                field_map[f].append(doc[f])
-
-        for k,v in field_map.items():
-            ret[k] = copy.deepcopy(v)
+        # output doc, with the source doc fields added as lists; the keys
+        # of a single doc are unique, so each list has one element
+        ret = {f: [copy.deepcopy(v)] for f, v in doc.items()
+               if f not in _NO_COPY_FIELDS}
 
         # set the context field explicitly
         ret[context_field] = doc[context_field]
@@ -58,8 +58,6 @@ import argparse
 import datetime
 import tempfile
 import subprocess
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure
 from collections import namedtuple, OrderedDict
 
 # modify path for local testing
@@ -84,6 +82,7 @@ except:
 _VERSION_MAJOR = 0
 _VERSION_MINOR = 9
 _MODULE_NAME   = 'expr_tester.py'
+_VERSION       = '{0} {1}.{2}'.format(_MODULE_NAME, _VERSION_MAJOR, _VERSION_MINOR)
 
 _TRACE = False
 
@@ -116,6 +115,38 @@ _BASIC_FEATURES = [
 # store computed result sets here, to speed things up
 _CACHE = {}
 
+# regexes for parsing NLPQL files; repeated whitespace is replaced with a
+# single space before these are applied, so they can use just \s
+_regex_comment = re.compile(r'//[^\n]+\n')
+
+_str_context_statement = r'context\s(?P<context>(patient|document));'
+_regex_context_statement = re.compile(_str_context_statement,
+                                      re.IGNORECASE | re.ASCII)
+
+_str_expr_statement = r'\bdefine\s(final\s)?(?P<feature>[^:]+):\s'  +\
+                      r'where\s(?P<expr>[^;]+);'
+_regex_expr_statement = re.compile(_str_expr_statement,
+                                   re.IGNORECASE | re.ASCII)
+
+# ClarityNLP task statements have no 'where' clause
+_str_task_statement = r'\bdefine\s(final\s)?(?P<feature>[^:]+):\s(?!where)'
+_regex_task_statement = re.compile(_str_task_statement,
+                                   re.IGNORECASE | re.ASCII)
+
+# max number of _id values in the '$in' list of a single MongoDB query
+_ID_BATCH_SIZE = 1000
+
+# source doc fields that expr_result.to_math_result_docs never reads
+_MATH_DOC_PROJECTION = {
+    'job_id'              : 0,
+    'phenotype_id'        : 0,
+    'owner'               : 0,
+    'job_date'            : 0,
+    'context_type'        : 0,
+    'raw_definition_text' : 0,
+    'phenotype_final'     : 0,
+}
+
 
 ###############################################################################
 def _enable_debug():
@@ -124,6 +155,31 @@ def _enable_debug():
     _TRACE = True
 
 
+###############################################################################
+def _find_docs(mongo_collection_obj, doc_ids, projection=None, doc_cache=None):
+    """
+    Query MongoDB for the docs with the given _id values, in batches of
+    _ID_BATCH_SIZE ids. Returns a list of the docs found.
+
+    If a 'doc_cache' dict is provided, only the docs missing from it are
+    queried, and these are added to it. The cache must only be used with a
+    single projection.
+    """
+
+    if doc_cache is None:
+        doc_cache = {}
+
+    missing = [oid for oid in doc_ids if oid not in doc_cache]
+    for i in range(0, len(missing), _ID_BATCH_SIZE):
+        batch = missing[i:i + _ID_BATCH_SIZE]
+        cursor = mongo_collection_obj.find({'_id': {'$in': batch}}, projection)
+        cursor.batch_size(_ID_BATCH_SIZE)
+        for doc in cursor:
+            doc_cache[doc['_id']] = doc
+
+    return [doc_cache[oid] for oid in doc_ids if oid in doc_cache]
+
+
 ###############################################################################
 def _evaluate_expressions(expr_obj_list,
                           mongo_collection_obj,
@@ -131,34 +187,59 @@ def _evaluate_expressions(expr_obj_list,
                           context_field,
                           is_final):
     """
-    Nearly identical to
-    nlp/luigi_tools/phenotype_helper.mongo_process_operations
+    Follows the control flow of
+    nlp/luigi_tools/phenotype_helper.mongo_process_operations: the
+    subexpressions are evaluated in order, one at a time. The differences:
+
+        - source docs for math results are fetched with _find_docs, which
+          projects away unused fields, queries in batches of _id values,
+          and reuses docs already fetched for an earlier subexpression
+        - result docs are written with unordered insert_many calls that are
+          deferred until a later subexpression needs them, or until all
+          subexpressions have been evaluated
     """
 
     phenotype_id    = _TEST_ID
     phenotype_owner = _TEST_ID
-        
+
     assert 'subject' == context_field or 'report_id' == context_field
 
     all_output_docs = []
     is_final_save = is_final
 
-    for expr_obj in expr_obj_list:
+    # source docs fetched for math results, keyed on _id; the subexpressions
+    # of an expression often share source docs, and the cache only lives
+    # for the duration of this call, which keeps its size bounded
+    doc_cache = {}
+
+    # Result docs are written to MongoDB in as few insert_many calls as
+    # possible. A subexpression that refers to the NLPQL feature of a pending
+    # write needs those docs in the collection, so the writes are flushed
+    # before it is evaluated. Feature names are matched as substrings, which
+    # can only cause an unneeded flush.
+    pending_writes = []
+    pending_features = set()
+
+    last_index = len(expr_obj_list) - 1
+    for i, expr_obj in enumerate(expr_obj_list):
 
         # the 'is_final' flag only applies to the last subexpression
-        if expr_obj != expr_obj_list[-1]:
+        if i != last_index:
             is_final = False
         else:
             is_final = is_final_save
-        
+
+        if pending_writes and any(f in expr_obj.expr_text
+                                  for f in pending_features):
+            mongo_collection_obj.insert_many(pending_writes, ordered=False)
+            pending_writes = []
+            pending_features.clear()
+
         # evaluate the (sub)expression in expr_obj
         eval_result = expr_eval.evaluate_expression(expr_obj,
                                                     job_id,
                                                     context_field,
                                                     mongo_collection_obj)
-            
-        # query MongoDB to get result docs
-        cursor = mongo_collection_obj.find({'_id': {'$in': eval_result.doc_ids}})
 
         # initialize for MongoDB result document generation
         phenotype_info = expr_result.PhenotypeInfo(
@@ -172,9 +253,15 @@ def _evaluate_expressions(expr_obj_list,
         # generate result documents
         if expr_eval.EXPR_TYPE_MATH == eval_result.expr_type:
 
+            # query MongoDB to get result docs
+            docs = _find_docs(mongo_collection_obj,
+                              eval_result.doc_ids,
+                              _MATH_DOC_PROJECTION,
+                              doc_cache)
+
             output_docs = expr_result.to_math_result_docs(eval_result,
                                                           phenotype_info,
-                                                          cursor)
+                                                          docs)
         else:
             assert expr_eval.EXPR_TYPE_LOGIC == eval_result.expr_type
 
@@ -188,7 +275,8 @@ def _evaluate_expressions(expr_obj_list,
                                                            oid_list_of_lists)
 
         if len(output_docs) > 0:
-            mongo_collection_obj.insert_many(output_docs)
+            pending_writes.extend(output_docs)
+            pending_features.add(expr_obj.nlpql_feature)
         else:
             print('mongo_process_operations ({0}): ' \
                   'no phenotype matches on "{1}".'.format(eval_result.expr_type,
@@ -197,9 +285,25 @@ def _evaluate_expressions(expr_obj_list,
         # save the expr object and the results
         all_output_docs.append( (expr_obj, output_docs))
 
+    if pending_writes:
+        mongo_collection_obj.insert_many(pending_writes, ordered=False)
+
     return all_output_docs
 
 
+###############################################################################
+def _create_indexes(mongo_collection_obj):
+    """
+    Create the indexes used by the deletes and queries of this code. MongoDB
+    does nothing if an index already exists.
+    """
+
+    mongo_collection_obj.create_index([('job_id', 1), ('nlpql_feature', 1)],
+                                      background=True)
+    mongo_collection_obj.create_index([('nlpql_feature', 1)],
+                                      background=True)
+
+
 ###############################################################################
 def _delete_prev_results(job_id, mongo_collection_obj):
     """
@@ -244,12 +348,13 @@ def _banner_print(msg):
         ws_right = ws+1
 
     star_count = 1 + ws_left + n + ws_right + 1
-        
-    print('{0}'.format('*'*star_count))
-    print('{0}{1}{2}'.format('*', ' '*(star_count-2), '*'))
-    print('{0}{1}{2}{3}{4}'.format('*', ' '*ws_left, msg, ' '*ws_right, '*'))
-    print('{0}{1}{2}'.format('*', ' '*(star_count-2), '*'))
-    print('{0}'.format('*'*star_count))
+
+    border = '*'*star_count
+    blank  = '{0}{1}{2}'.format('*', ' '*(star_count-2), '*')
+    line   = '{0}{1}{2}{3}{4}'.format('*', ' '*ws_left, msg, ' '*ws_right, '*')
+
+    # write the banner with a single call
+    sys.stdout.write('{0}\n{1}\n{2}\n{1}\n{0}\n'.format(border, blank, line))
     
 
 ###############################################################################
@@ -1582,6 +1687,10 @@ def _run_self_tests(job_id      = 11222,
     else:
         cf = 'report_id'
 
+    # pymongo is slow to import, so only load it when a connection is needed
+    from pymongo import MongoClient
+    from pymongo.errors import ConnectionFailure
+
     all_ok = False
     
     try:
@@ -1610,6 +1719,26 @@ def _run_self_tests(job_id      = 11222,
     return all_ok
 
     
+###############################################################################
+def _head_tail(docs, num):
+    """
+    Generate (index, doc) tuples for the docs at the start and end of the
+    'docs' list that should be displayed. A (None, None) tuple is generated
+    in place of the docs that are skipped.
+    """
+
+    n = len(docs)
+    head_end = min(num, n)
+    tail_start = max(head_end, n-num+1)
+
+    for k in range(head_end):
+        yield k, docs[k]
+    if num < n and num <= n-num:
+        yield None, None
+    for k in range(tail_start, n):
+        yield k, docs[k]
+
+
 ###############################################################################
 def _run_tests(job_id,
                final_nlpql_feature,
@@ -1634,6 +1763,7 @@ def _run_tests(job_id,
 
     # cleanup so that database only contains data generated by data_gen.nlpql
     # not from previous runs of this test code
+    _create_indexes(mongo_collection_obj)
     _delete_prev_results(job_id, mongo_collection_obj)
 
     if debug:
@@ -1686,9 +1816,8 @@ def _run_tests(job_id,
                 continue
 
             if expr_eval.EXPR_TYPE_MATH == expr_obj.expr_type:
-                for k in range(n):
-                    if k < num or k > n-num:
-                        doc = output_docs[k]
+                for k, doc in _head_tail(output_docs, num):
+                    if k is not None:
                         print(doc)
                         print('[{0:6}]: Document ...{1}, NLPQL feature {2}:'.
                               format(k, str(doc['_id'])[-6:],
@@ -1709,13 +1838,12 @@ def _run_tests(job_id,
                               '{3} data: {4}'.
                               format(k, doc['_id'], doc['nlpql_feature'],
                                      context_str, data_field))
-                    elif k == num:
+                    else:
                         print('\t...')
 
             else:
-                for k in range(n):
-                    if k < num or k > n-num:
-                        doc = output_docs[k]
+                for k, doc in _head_tail(output_docs, num):
+                    if k is not None:
                         print('[{0:6}]: Document ...{1}, NLPQL feature {2}:'.
                               format(k, str(doc['_id'])[-6:],
                                      expr_obj.nlpql_feature))
@@ -1740,7 +1868,7 @@ def _run_tests(job_id,
                                   format(str(tup.oid)[-6:], tup.pipeline_type,
                                          tup.nlpql_feature, context_str,
                                          data_string))
-                    elif k == num:
+                    else:
                         print('\t...')
                 
         counter += 1
@@ -1830,32 +1958,17 @@ def _parse_file(filepath):
     associated expressions. Returns a FileData namedtuple.
     """
 
-    # repeated whitespace replaced with single space below, so can use just \s
-    str_context_statement = r'context\s(?P<context>(patient|document));'
-    regex_context_statement = re.compile(str_context_statement, re.IGNORECASE)
-
-    str_expr_statement = r'\bdefine\s(final\s)?(?P<feature>[^:]+):\s'  +\
-                         r'where\s(?P<expr>[^;]+);'
-    regex_expr_statement = re.compile(str_expr_statement, re.IGNORECASE)
-
-    # ClarityNLP task statements have no 'where' clause
-    str_task_statement = r'\bdefine\s(final\s)?(?P<feature>[^:]+):\s(?!where)'
-    regex_task_statement = re.compile(str_task_statement, re.IGNORECASE)
-    
     with open(filepath, 'rt') as infile:
         text = infile.read()
 
     # strip comments
-    text = re.sub(r'//[^\n]+\n', ' ', text)
-
-    # replace newlines with spaces for regex simplicity
-    text = re.sub(r'\n', ' ', text)
+    text = _regex_comment.sub(' ', text)
 
-    # replace repeated spaces with a single space
-    text = re.sub(r'\s+', ' ', text)
+    # replace newlines and repeated whitespace with a single space
+    text = ' '.join(text.split())
 
     # extract the context
-    match = regex_context_statement.search(text)
+    match = _regex_context_statement.search(text)
     if match:
         context = match.group('context').strip()
     else:
@@ -1864,7 +1977,7 @@ def _parse_file(filepath):
 
     # extract expression definitions
     expression_dict = OrderedDict()
-    iterator = regex_expr_statement.finditer(text)
+    iterator = _regex_expr_statement.finditer(text)
     for match in iterator:
         feature = match.group('feature').strip()
         expression = match.group('expr').strip()
@@ -1876,7 +1989,7 @@ def _parse_file(filepath):
 
     # extract task definitions
     task_list = []
-    iterator = regex_task_statement.finditer(text)
+    iterator = _regex_task_statement.finditer(text)
     for match in iterator:
         task = match.group('feature').strip()
         if task in task_list:
@@ -1935,7 +2048,7 @@ def _parse_file(filepath):
 
 ###############################################################################
 def _get_version():
-    return '{0} {1}.{2}'.format(_MODULE_NAME, _VERSION_MAJOR, _VERSION_MINOR)
+    return _VERSION
 
 
 ###############################################################################
@@ -2024,6 +2137,7 @@ if __name__ == '__main__':
         
     if filename is not None or expr is not None:
         # live test, connect to ClarityNLP mongo collection nlp.phenotype_results
+        from pymongo import MongoClient
         mongo_client_obj = MongoClient(mongohost, mongoport)
         mongo_db_obj = mongo_client_obj['nlp']
         mongo_collection_obj = mongo_db_obj['phenotype_results']
@@ -2031,6 +2145,7 @@ if __name__ == '__main__':
     # delete any data computed from NLPQL expressions, will recompute
     # the task data is preserved
     if filename is not None:
+        _create_indexes(mongo_collection_obj)
         for nlpql_feature, expression in file_data.expressions:
 
             result = mongo_collection_obj.delete_many({"job_id":job_id,
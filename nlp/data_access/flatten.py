@@ -28,22 +28,6 @@
 # SOFTWARE.
 
 
-def _construct_key(previous_key, separator, new_key):
-    """
-    Returns the new_key if no previous key exists, otherwise concatenates
-    previous key, separator, and new_key
-    :param previous_key:
-    :param separator:
-    :param new_key:
-    :return: a string if previous_key exists and simply passes through the
-    new_key otherwise
-    """
-    if previous_key:
-        return u"{}{}{}".format(previous_key, separator, new_key)
-    else:
-        return new_key
-
-
 def flatten(nested_dict, separator="_", root_keys_to_ignore=set()):
     """
     Flattens a dictionary with nested structure to a dictionary with no
@@ -60,35 +44,41 @@ def flatten(nested_dict, separator="_", root_keys_to_ignore=set()):
     assert isinstance(nested_dict, dict), "flatten requires a dictionary input"
     assert isinstance(separator, str), "separator must be string"
 
-    # This global dictionary stores the flattened keys and values and is
+    # This dictionary stores the flattened keys and values and is
     # ultimately returned
     flattened_dict = dict()
 
-    def _flatten(object_, key):
-        """
-        For dict, list and set objects_ calls itself on the elements and for
-        other types assigns the object_ to
-        the corresponding key in the global flattened_dict
-        :param object_: object to flatten
-        :param key: carries the concatenated key for the object_
-        :return: None
-        """
+    # Walk the object iteratively with an explicit stack of (object_, key)
+    # pairs instead of recursing. Children are pushed in reverse order so
+    # that the keys are emitted in the same depth-first order as a recursive
+    # traversal.
+    stack = [(nested_dict, None)]
+    while stack:
+        object_, key = stack.pop()
         # Empty object can't be iterated, take as is
         if not object_:
             flattened_dict[key] = object_
         # These object types support iteration
         elif isinstance(object_, dict):
+            children = []
             for object_key in object_:
-                if not (not key and object_key in root_keys_to_ignore):
-                    _flatten(object_[object_key], _construct_key(key,
-                                                                 separator,
-                                                                 object_key))
+                if not key:
+                    if object_key in root_keys_to_ignore:
+                        continue
+                    child_key = object_key
+                else:
+                    child_key = f'{key}{separator}{object_key}'
+                children.append((object_[object_key], child_key))
+            stack.extend(reversed(children))
         elif isinstance(object_, (list, set, tuple)):
-            for index, item in enumerate(object_):
-                _flatten(item, _construct_key(key, separator, index))
+            if key:
+                children = [(item, f'{key}{separator}{index}')
+                            for index, item in enumerate(object_)]
+            else:
+                children = list(zip(object_, range(len(object_))))
+            stack.extend(reversed(children))
         # Anything left take as is
         else:
             flattened_dict[key] = object_
 
-    _flatten(nested_dict, None)
     return flattened_dict
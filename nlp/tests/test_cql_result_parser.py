@@ -0,0 +1,273 @@
+from datetime import datetime, timedelta, timezone
+
+from data_access import cql_result_parser as crp
+
+
+def _coding(*codes):
+    return {'coding': [{'code': c} for c in codes]}
+
+
+# fields common to all of the test resources
+_BASE = {
+    'id': '1',
+    'identifier': [{'type': _coding('MR'), 'value': 'x'}],
+    'extension': [{'url': 'u', 'valueCodeableConcept': _coding('a', 'b')}],
+}
+
+_BASE_LENGTHS = {
+    'len_identifier': 1,
+    'len_identifier_0_type_coding': 1,
+    'len_extension': 1,
+    'len_extension_0_valueCodeableConcept_coding': 2,
+}
+
+_CONTAINED_MED = {
+    'resourceType': 'Medication',
+    'code': _coding('m'),
+    'ingredient': [{'itemCodeableConcept': _coding('i', 'j')}],
+}
+
+
+def _len_fields(resource_type, **fields):
+    obj = dict(_BASE, resourceType=resource_type, **fields)
+    if 'Patient' == resource_type:
+        result = crp._process_patient(obj)
+    else:
+        result = crp._process_resource(obj)
+    return {k: v for k, v in result.items() if k.startswith('len_')}
+
+
+def test_observation_lengths():
+    lengths = _len_fields(
+        'Observation',
+        subject={'reference': 'Patient/99'},
+        category=[_coding('vital')],
+        code=_coding('8310-5'),
+        basedOn=[{'reference': 'x'}],
+        referenceRange=[{'meaning': _coding('n'),
+                         'appliesTo': [_coding('a', 'b')]}],
+        component=[{'code': _coding('c1', 'c2'),
+                    'interpretation': _coding('H')}])
+    assert lengths == dict(_BASE_LENGTHS, **{
+        'len_basedOn': 1,
+        'len_category': 1,
+        'len_category_0_coding': 1,
+        'len_code_coding': 1,
+        'len_component': 1,
+        'len_component_0_code_coding': 2,
+        'len_component_0_interpretation_coding': 1,
+        'len_referenceRange': 1,
+        'len_referenceRange_0_meaning_coding': 1,
+        'len_referenceRange_0_appliesTo': 1,
+        'len_referenceRange_0_appliesTo_0_coding': 2,
+    })
+
+
+def test_medication_administration_lengths():
+    lengths = _len_fields(
+        'MedicationAdministration',
+        subject={'reference': 'Patient/99'},
+        contained=[_CONTAINED_MED],
+        reasonNotGiven=[_coding('a', 'b')],
+        reasonGiven=[_coding('c')],
+        medicationCodeableConcept=_coding('m'),
+        note=[{'text': 't'}])
+    assert lengths == dict(_BASE_LENGTHS, **{
+        'len_contained': 1,
+        'len_contained_0_code_coding': 1,
+        'len_contained_0_ingredient': 1,
+        'len_contained_0_ingredient_0_itemCodeableConcept_coding': 2,
+        'len_medicationCodeableConcept_coding': 1,
+        'len_note': 1,
+        'len_reasonGiven': 1,
+        'len_reasonGiven_0_coding': 1,
+        'len_reasonNotGiven': 1,
+        'len_reasonNotGiven_0_coding': 2,
+    })
+
+
+def test_medication_request_lengths():
+    lengths = _len_fields(
+        'MedicationRequest',
+        subject={'reference': 'Patient/99'},
+        reasonCode=[_coding('r')],
+        dosageInstruction=[{'additionalInstruction': [_coding('a')],
+                            'route': _coding('PO'),
+                            'site': _coding('s')}])
+    assert lengths == dict(_BASE_LENGTHS, **{
+        'len_dosageInstruction': 1,
+        'len_dosageInstruction_0_additionalInstruction': 1,
+        'len_dosageInstruction_0_additionalInstruction_0_coding': 1,
+        'len_dosageInstruction_0_route_coding': 1,
+        'len_dosageInstruction_0_site_coding': 1,
+        'len_reasonCode': 1,
+        'len_reasonCode_0_coding': 1,
+    })
+
+
+def test_medication_order_lengths():
+    lengths = _len_fields(
+        'MedicationOrder',
+        patient={'reference': 'Patient/99'},
+        reasonEnded=_coding('e'),
+        dosageInstruction=[{'route': _coding('PO'),
+                            'timing': {'code': _coding('BID')}}])
+    assert lengths == dict(_BASE_LENGTHS, **{
+        'len_dosageInstruction': 1,
+        'len_dosageInstruction_0_route_coding': 1,
+        'len_dosageInstruction_0_timing_code_coding': 1,
+        'len_reasonEnded_coding': 1,
+    })
+
+
+def test_medication_statement_lengths():
+    lengths = _len_fields(
+        'MedicationStatement',
+        subject={'reference': 'Patient/99'},
+        reasonNotTaken=[_coding('a', 'b')],
+        dosage=[{'site': _coding('s'),
+                 'route': _coding('PO'),
+                 'additionalInstruction': [_coding('a')]}])
+    assert lengths == dict(_BASE_LENGTHS, **{
+        'len_dosage': 1,
+        'len_dosage_0_additionalInstruction': 1,
+        'len_dosage_0_additionalInstruction_0_coding': 1,
+        'len_dosage_0_route_coding': 1,
+        'len_dosage_0_site_coding': 1,
+        'len_reasonNotTaken': 1,
+        'len_reasonNotTaken_0_coding': 2,
+    })
+
+
+def test_condition_lengths():
+    lengths = _len_fields(
+        'Condition',
+        subject={'reference': 'Patient/99'},
+        category=[_coding('c')],
+        bodySite=[_coding('b')],
+        evidence=[{'code': [_coding('e')], 'detail': [{'reference': 'd'}]}])
+    assert lengths == dict(_BASE_LENGTHS, **{
+        'len_bodySite': 1,
+        'len_bodySite_0_coding': 1,
+        'len_category': 1,
+        'len_category_0_coding': 1,
+        'len_evidence': 1,
+        'len_evidence_0_code': 1,
+        'len_evidence_0_code_0_coding': 1,
+        'len_evidence_0_detail': 1,
+    })
+
+
+def test_encounter_lengths():
+    lengths = _len_fields(
+        'Encounter',
+        subject={'reference': 'Patient/99'},
+        type=[_coding('t')],
+        participant=[{'type': [_coding('p', 'q')]}],
+        reason=[_coding('r')],
+        diagnosis=[{'role': _coding('AD')}])
+    assert lengths == dict(_BASE_LENGTHS, **{
+        'len_diagnosis': 1,
+        'len_diagnosis_0_role_coding': 1,
+        'len_participant': 1,
+        'len_participant_0_type': 1,
+        'len_participant_0_type_0_coding': 2,
+        'len_reason': 1,
+        'len_reason_0_coding': 1,
+        'len_type': 1,
+        'len_type_0_coding': 1,
+    })
+
+
+def test_procedure_lengths():
+    lengths = _len_fields(
+        'Procedure',
+        subject={'reference': 'Patient/99'},
+        bodySite=[_coding('b')],
+        reasonCode=[_coding('r')],
+        performer=[{'role': _coding('p')}],
+        focalDevice=[{'action': _coding('a')}])
+    assert lengths == dict(_BASE_LENGTHS, **{
+        'len_bodySite': 1,
+        'len_bodySite_0_coding': 1,
+        'len_focalDevice': 1,
+        'len_focalDevice_0_action_coding': 1,
+        'len_performer': 1,
+        'len_performer_0_role_coding': 1,
+        'len_reasonCode': 1,
+        'len_reasonCode_0_coding': 1,
+    })
+
+
+def test_patient_lengths():
+    lengths = _len_fields(
+        'Patient',
+        name=[{'family': ['Smith'], 'given': ['J', 'K']}],
+        address=[{'line': ['1 Main St']}],
+        contact=[{'relationship': [_coding('N')],
+                  'telecom': [{'value': '555'}]}],
+        communication=[{'language': _coding('en')}])
+    assert lengths == dict(_BASE_LENGTHS, **{
+        'len_address': 1,
+        'len_address_0_line': 1,
+        'len_communication': 1,
+        'len_communication_0_language_coding': 1,
+        'len_contact': 1,
+        'len_contact_0_relationship': 1,
+        'len_contact_0_relationship_0_coding': 1,
+        'len_contact_0_telecom': 1,
+        'len_name': 1,
+        'len_name_0_family': 1,
+        'len_name_0_given': 2,
+    })
+
+
+def _tz(hours, minutes=0):
+    return timezone(timedelta(hours=hours, minutes=minutes))
+
+
+# expected results of _convert_datetimes, including the quirks of the
+# time_finder conversion: fractional seconds are read as a count of
+# microseconds, and the offset minutes are added with a positive sign
+_DATETIMES = [
+    ('2019-03-04T05:06:07Z',
+     datetime(2019, 3, 4, 5, 6, 7, tzinfo=timezone.utc)),
+    ('2019-03-04T05:06:07',
+     datetime(2019, 3, 4, 5, 6, 7, tzinfo=timezone.utc)),
+    ('2019-03-04T05:06:07+01:00',
+     datetime(2019, 3, 4, 5, 6, 7, tzinfo=_tz(1))),
+    ('2019-03-04T05:06:07-05:30',
+     datetime(2019, 3, 4, 5, 6, 7, tzinfo=_tz(-5, 30))),
+    ('2019-03-04T05:06:07-0500',
+     datetime(2019, 3, 4, 5, 6, 7, tzinfo=_tz(-5))),
+    ('2019-03-04T05:06:07+0130',
+     datetime(2019, 3, 4, 5, 6, 7, tzinfo=_tz(1, 30))),
+    ('2019-03-04T05:06:07+01',
+     datetime(2019, 3, 4, 5, 6, 7, tzinfo=_tz(1))),
+    ('2019-03-04T05:06:07.5Z',
+     datetime(2019, 3, 4, 5, 6, 7, 5, tzinfo=timezone.utc)),
+    ('2019-03-04T05:06:07.123456-05:00',
+     datetime(2019, 3, 4, 5, 6, 7, 123456, tzinfo=_tz(-5))),
+    ('2019-03-04',
+     datetime(2019, 3, 4)),
+    # not matched by _regex_time, so converted by the time_finder
+    ('2019-03-04T05:06:07::',
+     datetime(2019, 3, 4, 5, 6, 7, tzinfo=timezone.utc)),
+]
+
+
+def test_convert_datetimes():
+    for dt_str, expected in _DATETIMES:
+        result = crp._convert_datetimes({'k': dt_str})['k']
+        assert result == expected, dt_str
+        assert result.utcoffset() == expected.utcoffset(), dt_str
+        assert result.microsecond == expected.microsecond, dt_str
+
+
+def test_convert_datetimes_fallback():
+    # make sure that the time_finder case above is not handled by the regex
+    assert crp._regex_time.match('05:06:07::') is None
+
+    # other strings are not converted
+    obj = {'k': '1234-5', 'n': 42}
+    assert crp._convert_datetimes(dict(obj)) == obj
@@ -0,0 +1,93 @@
+from data_access import expr_tester as et
+
+
+class _FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def batch_size(self, size):
+        return self
+
+    def __iter__(self):
+        return iter(self.docs)
+
+
+class _FakeCollection:
+    """
+    Minimal stand-in for a pymongo collection that records each find query.
+    """
+
+    def __init__(self, docs):
+        self.docs = {doc['_id']: doc for doc in docs}
+        self.queries = []
+
+    def find(self, query, projection=None):
+        ids = query['_id']['$in']
+        self.queries.append((list(ids), projection))
+        # return the docs in a different order than requested
+        found = [self.docs[oid] for oid in ids if oid in self.docs]
+        return _FakeCursor(list(reversed(found)))
+
+
+def _head_tail_loop(docs, num):
+    """
+    The display loop that _head_tail replaced in _run_tests.
+    """
+
+    result = []
+    n = len(docs)
+    for k in range(n):
+        if k < num or k > n-num:
+            result.append( (k, docs[k]))
+        elif k == num:
+            result.append( (None, None))
+    return result
+
+
+def test_head_tail():
+    docs = list(range(10))
+    assert list(et._head_tail(docs, 3)) == [
+        (0, 0), (1, 1), (2, 2), (None, None), (8, 8), (9, 9)
+    ]
+    assert list(et._head_tail(docs, 20)) == [(k, k) for k in range(10)]
+    assert list(et._head_tail([], 3)) == []
+
+
+def test_head_tail_matches_loop():
+    for n in range(30):
+        docs = ['doc{0}'.format(k) for k in range(n)]
+        for num in range(20):
+            assert list(et._head_tail(docs, num)) == _head_tail_loop(docs, num)
+
+
+def test_find_docs_order():
+    coll = _FakeCollection([{'_id': k, 'value': k} for k in range(5)])
+    docs = et._find_docs(coll, [3, 1, 7, 4], {'job_id': 0})
+    assert [doc['_id'] for doc in docs] == [3, 1, 4]
+    assert coll.queries == [([3, 1, 7, 4], {'job_id': 0})]
+
+
+def test_find_docs_batches():
+    num_ids = 2 * et._ID_BATCH_SIZE + 1
+    coll = _FakeCollection([{'_id': k} for k in range(num_ids)])
+    docs = et._find_docs(coll, list(range(num_ids)))
+    assert [doc['_id'] for doc in docs] == list(range(num_ids))
+    assert [len(ids) for ids, projection in coll.queries] == [
+        et._ID_BATCH_SIZE, et._ID_BATCH_SIZE, 1
+    ]
+
+
+def test_find_docs_cache():
+    coll = _FakeCollection([{'_id': k} for k in range(5)])
+    doc_cache = {}
+    et._find_docs(coll, [0, 1, 2], doc_cache=doc_cache)
+    docs = et._find_docs(coll, [2, 3, 0], doc_cache=doc_cache)
+    assert [doc['_id'] for doc in docs] == [2, 3, 0]
+    # only the id missing from the cache is queried the second time
+    assert [ids for ids, projection in coll.queries] == [[0, 1, 2], [3]]
+    assert sorted(doc_cache) == [0, 1, 2, 3]
+
+    # ids that are not found are queried again
+    et._find_docs(coll, [9], doc_cache=doc_cache)
+    et._find_docs(coll, [9], doc_cache=doc_cache)
+    assert [ids for ids, projection in coll.queries][-2:] == [[9], [9]]